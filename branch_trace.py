@@ -0,0 +1,213 @@
+import csv
+import sys
+import gzip
+import lzma
+import zlib
+import queue
+import itertools
+import threading
+import struct
+import numpy as np
+from array import array
+
+# binary branch trace: a header, the interned pc table, one uint32 pc index
+# per branch and the outcomes packed 8 per byte (bit i % 8 of byte i // 8).
+# all sections are little endian and start at 8 byte aligned offsets so the
+# columns can be memory mapped in place.
+#
+# header: magic, version, branches, distinct pcs, pc table bytes, crc32 of
+# everything after the header. the pc table is the pcs as utf-8, one per line.
+MAGIC = b"BTRC"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQQI4x")
+
+def align(offset):
+    return -(-offset // 8) * 8
+
+# true if the file at path starts with the binary trace magic
+def is_binary_trace(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# one time conversion of a text trace of `pc,outcome` rows to the binary format
+def convert_trace(text_path,out_path):
+    pcs = {}
+    pc_index = array("I")
+    outcomes = array("B")
+    with open(text_path, "r") as csv_file:
+        for row in csv.reader(csv_file):
+            pc_index.append(pcs.setdefault(row[0], len(pcs)))
+            outcomes.append(int(row[1]))
+    write_trace(out_path, list(pcs), np.frombuffer(pc_index, dtype=np.uint32),
+                np.frombuffer(outcomes, dtype=np.uint8))
+
+# write a binary trace: pcs is the pc table, pc_index the table row of each
+# branch and outcomes its 0/1 outcome
+def write_trace(path,pcs,pc_index,outcomes):
+    assert(len(pc_index) == len(outcomes))
+    assert(len(pcs) < 2**32)
+    assert(not any("\n" in pc for pc in pcs))
+    table = "".join(pc + "\n" for pc in pcs).encode()
+    sections = [table, np.ascontiguousarray(pc_index, dtype="<u4").tobytes(),
+                np.packbits(np.asarray(outcomes, dtype=np.uint8), bitorder="little").tobytes()]
+
+    crc = 0
+    offset = HEADER.size
+    for section in sections:
+        crc = zlib.crc32(bytes(align(offset) - offset), crc)
+        crc = zlib.crc32(section, crc)
+        offset = align(offset) + len(section)
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(outcomes), len(pcs), len(table), crc))
+        for section in sections:
+            f.write(bytes(align(f.tell()) - f.tell()))
+            f.write(section)
+
+
+class BranchTrace:
+
+    # open a binary trace; the columns are memory mapped, so opening costs
+    # only the header and the pc table. verify=True also checks the crc32.
+    def __init__(self,path,verify=False) -> None:
+        with open(path, "rb") as f:
+            magic, version, self.n, n_pcs, table_bytes, self.crc = HEADER.unpack(f.read(HEADER.size))
+            assert(magic == MAGIC and version == VERSION)
+            self.pcs = f.read(table_bytes).decode().split("\n")[:n_pcs]
+        assert(len(self.pcs) == n_pcs)
+
+        index_offset = align(HEADER.size + table_bytes)
+        outcome_offset = align(index_offset + 4 * self.n)
+        self.path = path
+        if self.n:
+            self.pc_index = np.memmap(path, dtype="<u4", mode="r", offset=index_offset, shape=(self.n,))
+            self.outcome_bits = np.memmap(path, dtype=np.uint8, mode="r", offset=outcome_offset,
+                                          shape=(-(-self.n // 8),))
+        else:
+            # an empty file section cannot be mapped
+            self.pc_index = np.empty(0, dtype="<u4")
+            self.outcome_bits = np.empty(0, dtype=np.uint8)
+        if verify:
+            self.check()
+
+    # raise ValueError if the data does not match the header checksum
+    def check(self):
+        with open(self.path, "rb") as f:
+            f.seek(HEADER.size)
+            crc = 0
+            while block := f.read(1 << 24):
+                crc = zlib.crc32(block, crc)
+        if crc != self.crc:
+            raise ValueError(f"{self.path}: checksum mismatch")
+
+    def __len__(self):
+        return self.n
+
+    # (pc, taken) of branch i, like the rows of a text trace
+    def __getitem__(self,i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        taken = (int(self.outcome_bits[i >> 3]) >> (i & 7)) & 1
+        return self.pcs[int(self.pc_index[i])], bool(taken)
+
+    # 0/1 outcomes of branches lo..hi as a uint8 array
+    def outcomes(self,lo=0,hi=None):
+        hi = self.n if hi is None else min(hi, self.n)
+        bits = np.unpackbits(self.outcome_bits[lo >> 3:-(-hi // 8)], bitorder="little")
+        return bits[lo & 7:(lo & 7) + hi - lo]
+
+
+# open a text trace for reading, decompressing gzip and xz/lzma files
+def open_text_trace(path):
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(path, "rt")
+    if magic == b"\xfd7zXZ\x00" or path.endswith(".lzma"):
+        return lzma.open(path, "rt")
+    return open(path, "r")
+
+# yield (pcs, outcomes) chunks of at most `chunk` branches from a binary,
+# text or compressed text trace, so memory is bounded by the chunk size. pcs
+# is an object array of pc strings and outcomes a uint8 array of 0/1.
+# reverse=True yields the branches last to first (the order initialize()
+# gives the branch predictor); only binary traces can be read backwards.
+def read_chunks(path,chunk=1 << 20,reverse=False):
+    if is_binary_trace(path):
+        trace = BranchTrace(path)
+        pcs = np.array(trace.pcs, dtype=object)
+        starts = range(0, len(trace), chunk)
+        for lo in (reversed(starts) if reverse else starts):
+            hi = min(lo + chunk, len(trace))
+            step = -1 if reverse else 1
+            yield pcs[trace.pc_index[lo:hi]][::step], trace.outcomes(lo,hi)[::step]
+        return
+
+    if reverse:
+        raise ValueError(f"{path}: only binary traces can be read in reverse")
+    with open_text_trace(path) as text_file:
+        rows = csv.reader(text_file)
+        while rows_chunk := list(itertools.islice(rows, chunk)):
+            yield (np.array([row[0] for row in rows_chunk], dtype=object),
+                   np.array([int(row[1]) for row in rows_chunk], dtype=np.uint8))
+
+
+# iterate over chunks with up to `depth` of them read ahead on a background
+# thread, so reading and decoding the next chunks overlaps with simulating
+# the current one. the queue is bounded (the reader waits while it is full),
+# an exception in the reader is raised in the consumer, and closing the
+# generator early stops the reader, which then closes the source itself.
+def prefetch(chunks,depth=2):
+    assert(depth >= 1)
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    # False once the consumer has gone away
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        source = iter(chunks)
+        try:
+            for chunk in source:
+                if not put((chunk, None)):
+                    return
+            put((done, None))
+        except BaseException as error:
+            put((done, error))
+        finally:
+            if hasattr(source, "close"):
+                source.close()
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk, error = items.get()
+            if chunk is done:
+                if error is not None:
+                    raise error
+                return
+            yield chunk
+    finally:
+        stop.set()
+        reader.join()
+
+
+def main():
+    assert(len(sys.argv) == 3)
+    convert_trace(sys.argv[1], sys.argv[2])
+    trace = BranchTrace(sys.argv[2], verify=True)
+    print(f"{len(trace)} branches, {len(trace.pcs)} pcs -> {sys.argv[2]}")
+
+if __name__ == "__main__":
+    main()
@@ -1,103 +1,304 @@
 from hdc import *
 from rev_list import *
+from branch_trace import BranchTrace, is_binary_trace, read_chunks, prefetch
+import os
 import csv
+import contextlib
 import tqdm
+import multiprocessing
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 from enum import Enum
 
+TRACE_PATH = "./data/traces/410185-dataset.txt"
+RESULTS_PATH = "./data/traces/410185-dataset-results.txt"
+
 class encodingType(Enum):
     RUNNING_BUNDLE = "RB"
     BASELINE = "BL" 
+    WINDOWED = "WB"
 
 class branchPredictor:
     
-    def __init__(self,history,k=3):
+    # decisions: an existing "0"/"1" codebook to share (default: a new one)
+    def __init__(self,history,k=3,hdc=HDC,window=1024,decisions=None):
         # initialize size of k-grams
         self.k = k
+
+        # hypervector backend (HDC for 0/1 arrays, PackedHDC for uint64 words)
+        self.hdc = hdc
         
         # initialize atomics -- decisions 
-        self.decisions = HDCodebook()
-        self.decisions.add("0")
-        self.decisions.add("1")
-
-        # initialize vector stores
-        self.history = history
-        self.history_vecs = self.list_to_vec(history)
+        if decisions is None:
+            decisions = HDCodebook(hdc=hdc)
+            decisions.add("0")
+            decisions.add("1")
+        self.decisions = decisions
+
+        # initialize vector stores. only the compact decisions are kept;
+        # grams are looked up in tables built from the codebook (run_table)
+        self.history = np.asarray(history, dtype=np.uint8)
         self.grams = []
-        self.unthr_grams = np.zeros(HDC.SIZE)
-        self.num_grams = 0
+        self.accumulator = BundleAccumulator(hdc)
+
+        # per-gram occurrence counts for the baseline encoding
+        self.baseline_k = None
+        self.baseline_counts = None
+        self.baseline_next = 0
+
+        # sliding window: ring of the ids of the last `window` grams
+        self.window = window
+        self.window_acc = BundleAccumulator(hdc, dtype=np.int16 if window < 2**15 else np.int32)
+        self.window_ring = np.zeros(window, dtype=np.int64)
+        self.window_pos = 0
+        self.window_len = 0
 
         self.encoding_type = encodingType.RUNNING_BUNDLE
-        
 
-    # convert list of decisions to list of representative vectors
-    def list_to_vec(self,decision_list):
-        return np.array([self.decisions.get(str(decision)) for decision in decision_list])
-    
+
+    # the decision codebook. the gram tables and scratch buffers are built
+    # from it, so assigning a new codebook drops them
+    @property
+    def decisions(self):
+        return self._decisions
+
+    @decisions.setter
+    def decisions(self,decisions):
+        self._decisions = decisions
+        self.clear_tables()
+
+
+    # drop everything derived from the codebook; call this after changing
+    # its vectors in place
+    def clear_tables(self):
+        # decisions are binary, so an n-decision run has only 2**n possible
+        # hypervectors; these tables cache them per n (see run_table)
+        self.run_tables = {}
+        self.query_tables = {}
+        self.bit_tables = {}
+        self.query_bit_tables = {}
+
+        # scratch buffers for predict_inplace (and predict_incremental's
+        # distance tracker), made for this k on first use
+        self.scratch_k = None
+        self.tracker = None
+        
 
     # create gram out of given list of decision vectors 
     def encode_run(self,decision_vecs):
-        return HDC.bind_all([HDC.permute(decision_vecs[i],i) for i in range(len(decision_vecs))])
+        return self.hdc.bind_all([self.hdc.rotate(decision_vecs[i],i) for i in range(len(decision_vecs))])
 
     
     def encode_history(self,i):
         if self.encoding_type == encodingType.RUNNING_BUNDLE:
             return self.encode_history_running_bundle(i)
+        elif self.encoding_type == encodingType.WINDOWED:
+            return self.encode_history_windowed(i)
         else:
             return self.encode_history_baseline(i)
 
 
+    # integer value of the run of decisions history[lo:hi], bit m holding
+    # history[lo+m]
+    def run_index(self,lo,hi):
+        value = 0
+        for m, bit in enumerate(self.history[lo:hi].tolist()):
+            value |= bit << m
+        return value
+
+
+    # table of the encoded hypervectors of all 2**n runs of n decisions,
+    # indexed by run_index
+    def run_table(self,n):
+        if n not in self.run_tables:
+            runs = [self.encode_run([self.decisions.get(str((v >> m) & 1)) for m in range(n)])
+                    for v in range(2**n)]
+            self.run_tables[n] = np.array([np.asarray(run) for run in runs])
+        return self.run_tables[n]
+
+
+    # table of the 2**(k-1) query hypervectors, indexed like run_table(k-1)
+    def query_table(self,k):
+        if k not in self.query_tables:
+            self.query_tables[k] = self.hdc.permute(self.run_table(k-1),1)
+        return self.query_tables[k]
+
+
     # assumes that history is long enough for k-gram
     # create history vector by encoding past branch decisions
     def encode_history_running_bundle(self,i):
-        # get vectors of current k-gram
-        run = self.history_vecs[i-self.k:i]
-
-        # encode run by binding
-        run = self.encode_run(run)
+        # look up the encoded current k-gram
+        run = self.run_table(self.k)[self.run_index(i-self.k,i)]
 
         # add current gram to unthresholded grams
-        self.unthr_grams += run
-
-        # must keep track of number of grams thus far processed
-        self.num_grams += 1
+        self.accumulator.add(run)
 
         # return thresholded run
-        return (self.unthr_grams > (self.num_grams / 2)).astype(int)
+        return self.accumulator.value()
         
         
-    # calculates entire sum every time
+    # integer id of the k-gram history[i-k:i]: bit m holds history[i-k+m]
+    # and a leading 1 at bit k records the gram length
+    def gram_id(self,i):
+        return self.run_index(i-self.k,i) | (1 << self.k)
+
+
+    # look the gram hypervector up from its id
+    def gram_from_id(self,gram_id):
+        k = gram_id.bit_length() - 1
+        return self.run_table(k)[gram_id ^ (1 << k)]
+
+
+    # running bundle over the last `window` grams only: add the newest gram
+    # and subtract the one leaving the window
+    def encode_history_windowed(self,i):
+        self.window_update(self.gram_id(i), self.gram_from_id)
+        return self.window_acc.value()
+
+
+    # push gram_id into the window ring, adding its gram to the window bundle
+    # and subtracting the evicted one; lookup maps an id to its gram
+    # (bits=True when lookup returns unpacked bits)
+    def window_update(self,gram_id,lookup,bits=False):
+        self.window_acc.add(lookup(gram_id),bits=bits)
+
+        # evict the oldest gram once the window is full
+        if self.window_len == self.window:
+            self.window_acc.subtract(lookup(int(self.window_ring[self.window_pos])),bits=bits)
+        else:
+            self.window_len += 1
+
+        self.window_ring[self.window_pos] = gram_id
+        self.window_pos = (self.window_pos + 1) % self.window
+        
+        
+    # bundle of every gram so far, i.e. of history[j:j+k] for j <= i-k. only
+    # 2**k distinct grams exist, so the bundle is kept as a count per gram
+    # (updated incrementally) and computed as a counts-weighted sum over the
+    # gram table: O(2**k * SIZE) per step and bit-exact with bundling them all.
     def encode_history_baseline(self,i):
-        # create list of bound k-grams
-        grams = []
-        for j in range(i-self.k+1):
-            run = self.history_vecs[j:j+self.k]
-            grams.append(self.encode_run(run))
+        # start over when k changed or the history is replayed
+        if self.baseline_k != self.k or i-self.k+1 < self.baseline_next:
+            self.baseline_k = self.k
+            self.baseline_counts = np.zeros(2**self.k)
+            self.baseline_next = 0
+
+        # count grams that entered the history since the last call
+        for j in range(self.baseline_next, i-self.k+1):
+            self.baseline_counts[self.run_index(j,j+self.k)] += 1
+        self.baseline_next = i-self.k+1
 
-        # bundle together and return 
-        return HDC.bundle(grams)
+        # bundle together and return. the bit table is float so the weighted
+        # sum is a BLAS product (exact while counts stay below 2**53)
+        sums = self.baseline_counts @ self.bit_table(self.k,np.float64)
+        return self.hdc.from_bits((sums > (self.baseline_counts.sum() / 2)).astype(int))
+
+
+    # run_table(n) unpacked to 0/1 bits of the given dtype
+    def bit_table(self,n,dtype):
+        if (n,dtype) not in self.bit_tables:
+            self.bit_tables[(n,dtype)] = self.hdc.to_bits(self.run_table(n)).astype(dtype)
+        return self.bit_tables[(n,dtype)]
 
 
     # assumes that history is long enough for k-gram
     # create query vector from last k-1 items from memory
     def make_query(self,i):
 
-        # retrieve last k-1 items from history
-        query_vecs = self.history_vecs[i-self.k+1:i]
-
-        # encode run
-        run = self.encode_run(query_vecs)
-
-        # permute by 1 to cancel out desired section
-        return HDC.permute(run,1)
+        # look up the encoded last k-1 items from history, permuted by 1 to
+        # cancel out desired section
+        return self.query_table(self.k)[self.run_index(i-self.k+1,i)]
 
 
     # predict next branch outcome based on current decision vector
     def predict(self,history_hv,query_hv):
-        return int(self.decisions.wta(HDC.bind(history_hv,query_hv)))
+        return int(self.decisions.wta_bind(history_hv,query_hv))
+
+
+    # preallocate the buffers used by predict_inplace. everything is kept as
+    # unpacked bits: gram rows in the accumulators' counter dtype, queries and
+    # decisions as bools.
+    def make_scratch(self):
+        self.scratch_history = np.empty(self.hdc.SIZE, dtype=bool)
+        self.scratch_bound = np.empty(self.hdc.SIZE, dtype=bool)
+        self.scratch_diff = np.empty(self.hdc.SIZE, dtype=bool)
+        self.scratch_decisions = self.hdc.to_bits(self.decisions.matrix()).astype(bool)
+        self.scratch_k = self.k
+
+        # distance tracker of predict_incremental
+        self.tracker = None
+
+
+    # same prediction as predict(encode_history(i), make_query(i)) for the
+    # running bundle and windowed encodings, but every SIZE-length result goes
+    # through the scratch buffers, so steady-state steps allocate no arrays
+    def predict_inplace(self,i):
+        if self.scratch_k != self.k:
+            self.make_scratch()
+        gram = self.run_index(i-self.k,i)
+        self.update_bundle_inplace(gram)
+
+        # bind with the query: its k-1 bits are the gram without its oldest
+        np.bitwise_xor(self.scratch_history, self.query_bit_table(self.k)[gram >> 1], out=self.scratch_bound)
+
+        # winner-take-all over the decisions, first key winning ties like wta
+        best, best_dist = 0, self.hdc.SIZE + 1
+        for row in range(len(self.scratch_decisions)):
+            np.not_equal(self.scratch_bound, self.scratch_decisions[row], out=self.scratch_diff)
+            dist = np.count_nonzero(self.scratch_diff)
+            if dist < best_dist:
+                best, best_dist = row, dist
+        return int(self.decisions.keys[best])
+
+
+    # add the gram to the history bundle in place and threshold it into
+    # scratch_history
+    def update_bundle_inplace(self,gram):
+        if self.encoding_type == encodingType.RUNNING_BUNDLE:
+            acc = self.accumulator
+            acc.add(self.bit_table(self.k,acc.counts.dtype)[gram],bits=True)
+        elif self.encoding_type == encodingType.WINDOWED:
+            acc = self.window_acc
+            self.window_update(gram | (1 << self.k),self.window_bits_from_id,bits=True)
+        else:
+            raise ValueError(f"no in-place path for {self.encoding_type}")
+        acc.value_into(self.scratch_history)
+
+
+    # same prediction as predict_inplace, but the distances of
+    # bind(history, query) to the decisions are tracked across steps: only
+    # the positions where the thresholded history flipped or the query
+    # changed (i.e. where the bound vector changed) are revisited
+    def predict_incremental(self,i):
+        if self.scratch_k != self.k:
+            self.make_scratch()
+        gram = self.run_index(i-self.k,i)
+        self.update_bundle_inplace(gram)
+        np.bitwise_xor(self.scratch_history, self.query_bit_table(self.k)[gram >> 1], out=self.scratch_bound)
+
+        if self.tracker is None:
+            self.tracker = HDDistanceTracker(self.decisions)
+            self.tracker.reset(self.hdc.from_bits(self.scratch_bound))
+        else:
+            self.tracker.update(self.scratch_bound)
 
-    # test predictor
-    def test(self,plot=True):
+        return int(self.tracker.wta())
+
+
+    # gram of an id as unpacked bits in the window counters' dtype
+    def window_bits_from_id(self,gram_id):
+        k = gram_id.bit_length() - 1
+        return self.bit_table(k,self.window_acc.counts.dtype)[gram_id ^ (1 << k)]
+
+
+    # query_table(k) unpacked to bools
+    def query_bit_table(self,k):
+        if k not in self.query_bit_tables:
+            self.query_bit_tables[k] = self.hdc.to_bits(self.query_table(k)).astype(bool)
+        return self.query_bit_tables[k]
+
+    # test predictor; results_path=None skips writing the predictions
+    def test(self,plot=True,inplace=False,incremental=False,results_path=RESULTS_PATH):
 
         if plot == True: 
             print("======= testing predictor ======")
@@ -106,7 +307,7 @@ class branchPredictor:
         correct = 0
         accuracies = []
 
-        with open("./data/traces/410185-dataset-results.txt", "w") as results_file:
+        with open(results_path or os.devnull, "w") as results_file:
 
             for i in (pbar := tqdm.tqdm(range(len(self.history)))):
 
@@ -120,12 +321,7 @@ class branchPredictor:
 
                 # otherwise, make prediction based on history
                 else:
-                    # make history and query vectors
-                    history_hv = self.encode_history(i)  
-                    query_hv = self.make_query(i)
-                    
-                    # generate prediction and compare to actual 
-                    prediction = self.predict(history_hv,query_hv)
+                    prediction = self.predict_step(i,inplace,incremental)
 
                 # update accuracy using actual decision
                 actual = self.history[i]
@@ -150,32 +346,290 @@ class branchPredictor:
             return accuracies
 
 
+    # prediction for step i (i >= k) on the path test() was asked for
+    def predict_step(self,i,inplace=False,incremental=False):
+        if incremental:
+            return self.predict_incremental(i)
+
+        if inplace:
+            return self.predict_inplace(i)
+
+        # make history and query vectors
+        history_hv = self.encode_history(i)  
+        query_hv = self.make_query(i)
+        
+        # generate prediction and compare to actual 
+        return self.predict(history_hv,query_hv)
+
+
+    # test() over a stream of history chunks (e.g. from stream_history) so
+    # that memory is bounded by the chunk size: self.history only holds the
+    # current chunk behind the last k decisions of the one before, which the
+    # grams spanning the boundary need. predictions match test() on the
+    # concatenated history; accuracies are returned once per chunk. the next
+    # read_ahead chunks are read on a background thread (0 disables).
+    def test_stream(self,chunks,plot=True,inplace=False,incremental=False,results_path=RESULTS_PATH,read_ahead=2):
 
-def initialize(k=3):
+        if plot == True: 
+            print("======= testing predictor ======")
+
+        if read_ahead:
+            chunks = prefetch(chunks,read_ahead)
+
+        correct = 0
+        seen = 0
+        accuracies = []
+        self.history = np.empty(0, dtype=np.uint8)
+        self.baseline_k = None
+
+        # closing the prefetching reader stops it even if a prediction raises
+        reader = contextlib.closing(chunks) if read_ahead else contextlib.nullcontext()
+        with open(results_path or os.devnull, "w") as results_file, reader:
+
+            for chunk in (pbar := tqdm.tqdm(chunks)):
+                tail = self.history[max(0, len(self.history)-self.k):]
+
+                # history indices move back by the decisions dropped
+                self.baseline_next -= len(self.history) - len(tail)
+                self.history = np.concatenate([tail, np.asarray(chunk, dtype=np.uint8)])
+
+                for i in range(len(tail), len(self.history)):
+                    if seen + i - len(tail) < self.k:
+                        prediction = 1 if np.random.rand() < 0.5 else 0
+                    else:
+                        prediction = self.predict_step(i,inplace,incremental)
+
+                    if prediction == self.history[i]:
+                        correct += 1
+                    results_file.write(f"410185,{prediction}\n")
+
+                seen += len(self.history) - len(tail)
+                accuracy = float(correct) / max(seen, 1)
+                accuracies.append(accuracy)
+                pbar.set_description("accuracy=%f" % accuracy)
+
+        if plot == True:
+            make_plot(self,func=0,accuracies=accuracies)
+            print(f"ACCURACY: {accuracy}")
+
+        else:
+            return accuracies
+
+
+    # ids (run_index values) of the grams added at steps lo..hi-1, i.e. of
+    # history[i-k:i] for each step i
+    def gram_indices(self,lo,hi):
+        windows = np.lib.stride_tricks.sliding_window_view(self.history[lo-self.k:hi-1], self.k)
+        return windows.astype(np.int64) @ (1 << np.arange(self.k, dtype=np.int64))
+
+
+    # parallel version of test() for the running bundle (and the baseline,
+    # which bundles the same grams), matching a serial run on a fresh
+    # predictor exactly. the history bundle at step i only depends on how
+    # often each gram occurred before i, so:
+    #   1. the steps are split into chunks,
+    #   2. workers count the grams of each chunk,
+    #   3. an exclusive scan of those counts gives each chunk its starting
+    #      bundle, from which workers predict their chunk.
+    def test_parallel(self,plot=True,processes=None,chunks=None,results_path=RESULTS_PATH):
+        if self.encoding_type == encodingType.WINDOWED:
+            raise ValueError("parallel evaluation needs a prefix bundle, not a window")
+
+        if plot == True: 
+            print("======= testing predictor (parallel) ======")
+
+        processes = processes or multiprocessing.cpu_count()
+        chunks = chunks or 4 * processes
+        n = len(self.history)
+
+        # random predictions while the history is shorter than k, drawn
+        # exactly as test() draws them
+        predictions = np.empty(n, dtype=np.uint8)
+        for i in range(min(self.k, n)):
+            predictions[i] = 1 if np.random.rand() < 0.5 else 0
+
+        bounds = np.linspace(min(self.k, n), n, chunks + 1).astype(int)
+        ranges = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if lo < hi]
+
+        state = (HDC.SIZE, self.history, self.k, self.hdc, self.decisions)
+        with multiprocessing.Pool(processes, initializer=init_worker, initargs=state) as pool:
+            counts = pool.starmap(chunk_gram_counts, ranges)
+            offsets = np.cumsum([np.zeros(2**self.k, dtype=np.int64)] + counts[:-1], axis=0)
+            chunk_predictions = pool.starmap(predict_chunk, [(lo, hi, offset) for (lo, hi), offset in zip(ranges, offsets)])
+
+        for (lo, hi), chunk in zip(ranges, chunk_predictions):
+            predictions[lo:hi] = chunk
+
+        # accuracy after every decision, as in test()
+        accuracies = (np.cumsum(predictions == self.history) / np.arange(1, n + 1)).tolist()
+
+        with open(results_path or os.devnull, "w") as results_file:
+            results_file.writelines(f"410185,{prediction}\n" for prediction in predictions.tolist())
+
+        if plot == True:
+            make_plot(self,func=0,accuracies=accuracies)
+            print(f"ACCURACY: {accuracies[-1]}")
+
+        else:
+            return accuracies
+
+
+# running-bundle predictors for several k at once, walking the trace a single
+# time. an n-gram is the (n-1)-gram of the previous step bound with one more
+# permuted decision, G_n(i) = bind(G_{n-1}(i-1), permute(d[i-1], n-1)), and
+# the query for k is the (k-1)-gram permuted by 1, so every step derives all
+# grams from the previous step's partial bindings with one bind per length.
+# per-k accuracies are identical to running branchPredictor.test on fresh
+# predictors with the same codebook, one k after the other.
+class multiKPredictor:
+
+    def __init__(self,history,k_vals=[i for i in range(3,10)],hdc=HDC,decisions=None):
+        assert(min(k_vals) >= 2)
+        self.history = np.asarray(history, dtype=np.uint8)
+        self.k_vals = list(k_vals)
+        self.hdc = hdc
+        self.encoding_type = encodingType.RUNNING_BUNDLE
+
+        # share an existing decision codebook or make a new one
+        if decisions is None:
+            decisions = HDCodebook(hdc=hdc)
+            decisions.add("0")
+            decisions.add("1")
+        self.decisions = decisions
+
+
+    # accuracy after every decision, per k. like predict_inplace, everything
+    # is kept as unpacked bits in preallocated buffers: grams are xored in
+    # place, the query's rotation by 1 is folded into the bind, and the
+    # winner-take-all counts mismatches against the decision bits.
+    def test(self,plot=True):
+        n = len(self.history)
+        kmax = max(self.k_vals)
+        size = self.hdc.SIZE
+
+        # warm-up random predictions, drawn in the order separate test() runs
+        # would draw them
+        warmup = {k: [1 if np.random.rand() < 0.5 else 0 for _ in range(min(k, n))] for k in self.k_vals}
+
+        # shifted[m][b]: decision b permuted by m, as bits
+        decision_bits = self.hdc.to_bits(self.decisions.matrix()).astype(bool)
+        rows = [decision_bits[self.decisions.index[str(b)]] for b in (0, 1)]
+        shifted = [[np.roll(row, m) for row in rows] for m in range(kmax)]
+
+        # grams[m] holds the m-gram ending at the current step
+        grams = np.zeros((kmax + 1, size), dtype=bool)
+        accumulators = {k: BundleAccumulator(self.hdc) for k in self.k_vals}
+        history_bits = np.empty(size, dtype=bool)
+        bound = np.empty(size, dtype=bool)
+        diff = np.empty(size, dtype=bool)
+        correct = dict.fromkeys(self.k_vals, 0)
+        all_accuracies = {k: [] for k in self.k_vals}
+
+        for i in tqdm.tqdm(range(n)):
+            if i >= 1:
+                # longest first, so each length still sees the previous step's
+                # shorter gram
+                decision = int(self.history[i-1])
+                for m in range(min(i, kmax), 1, -1):
+                    np.bitwise_xor(grams[m-1], shifted[m-1][decision], out=grams[m])
+                grams[1] = rows[decision]
+
+            actual = self.history[i]
+            for k in self.k_vals:
+                if i < k:
+                    prediction = warmup[k][i]
+                else:
+                    accumulators[k].add(grams[k],bits=True)
+                    accumulators[k].value_into(history_bits)
+
+                    # bind with the (k-1)-gram rotated by 1
+                    np.bitwise_xor(history_bits[1:], grams[k-1][:-1], out=bound[1:])
+                    np.bitwise_xor(history_bits[:1], grams[k-1][-1:], out=bound[:1])
+
+                    # winner-take-all, first key winning ties like wta_bind
+                    best, best_dist = 0, size + 1
+                    for row in range(len(decision_bits)):
+                        np.not_equal(bound, decision_bits[row], out=diff)
+                        dist = np.count_nonzero(diff)
+                        if dist < best_dist:
+                            best, best_dist = row, dist
+                    prediction = int(self.decisions.keys[best])
+
+                if prediction == actual:
+                    correct[k] += 1
+                all_accuracies[k].append(float(correct[k]) / (i+1))
+
+        if plot == True:
+            for k,accuracies in all_accuracies.items():
+                print(f"k={k} accuracy={accuracies[-1]}")
+            make_plot(self,func=1,all_accuracies=all_accuracies)
+
+        else:
+            return all_accuracies
+
+
+# per-process predictor for test_parallel's workers
+worker_predictor = None
+
+def init_worker(size,history,k,hdc,decisions):
+    global worker_predictor
+    HDC.SIZE = size
+    worker_predictor = branchPredictor(history,k=k,hdc=hdc,decisions=decisions)
+
+# occurrences of each gram id added at steps lo..hi-1
+def chunk_gram_counts(lo,hi):
+    predictor = worker_predictor
+    return np.bincount(predictor.gram_indices(lo,hi), minlength=2**predictor.k)
+
+# predictions for steps lo..hi-1, starting from the bundle of the grams
+# counted in offset
+def predict_chunk(lo,hi,offset):
+    predictor = worker_predictor
+    predictor.encoding_type = encodingType.RUNNING_BUNDLE
+    predictor.accumulator.clear()
+    for gram in np.flatnonzero(offset).tolist():
+        predictor.accumulator.add(predictor.run_table(predictor.k)[gram],weight=offset[gram])
+    return np.array([predictor.predict_inplace(i) for i in range(lo,hi)], dtype=np.uint8)
+
+
+# path is a text trace of `pc,outcome` rows or a binary trace written by
+# branch_trace.py, which is memory mapped instead of parsed
+def initialize(k=3,hdc=HDC,path=TRACE_PATH):
     # initialize data 
     HDC.SIZE = 10000
 
     # initialize decisions
-    decisions = []
-    with open("./data/traces/410185-dataset.txt","r") as csv_file:
-        csv_reader = csv.reader(csv_file)
-        #decisions = [row["decision"] for row in csv_reader]
-
-        for row in csv_reader:
-            decisions.append(int(row[1]))
+    if is_binary_trace(path):
+        decisions = BranchTrace(path).outcomes()
+    else:
+        decisions = []
+        with open(path,"r") as csv_file:
+            csv_reader = csv.reader(csv_file)
+            #decisions = [row["decision"] for row in csv_reader]
+
+            for row in csv_reader:
+                decisions.append(int(row[1]))
             
-    # convert into numpy list
-    decisions = np.array(decisions)
+        # convert into numpy list
+        decisions = np.array(decisions)
 
     # reverse decisions array to get most recent decisions first
     decisions = np.flip(decisions)
 
     # initialize branch predictor
-    predictor = branchPredictor(decisions,k=k)
+    predictor = branchPredictor(decisions,k=k,hdc=hdc)
 
     return predictor
 
 
+# the trace's decisions as history chunks for branchPredictor.test_stream,
+# most recent first like initialize() (needs a binary trace, the only kind
+# that can be read backwards); reverse=False keeps the trace order
+def stream_history(path=TRACE_PATH,chunk=1 << 20,reverse=True):
+    for _, outcomes in read_chunks(path,chunk,reverse):
+        yield outcomes
+
+
 # test different k-gram sizes
 def test_k_gram_sizes(predictor,k_vals=[i for i in range(3,10)]):
 
@@ -196,6 +650,60 @@ def test_k_gram_sizes(predictor,k_vals=[i for i in range(3,10)]):
     make_plot(predictor,func=1,all_accuracies=all_accuracies)
         
 
+# test different k-gram sizes in parallel, each in its own process with a
+# fresh predictor (test_k_gram_sizes reuses one predictor, so its bundle
+# carries over between k values). the decisions are placed in shared memory
+# once instead of being pickled to every worker.
+def sweep_k_gram_sizes(predictor,k_vals=[i for i in range(3,10)],processes=None):
+
+    print("======= sweeping k-gram sizes ======")
+
+    history = shared_memory.SharedMemory(create=True, size=max(1, predictor.history.nbytes))
+    try:
+        np.ndarray(predictor.history.shape, dtype=np.uint8, buffer=history.buf)[:] = predictor.history
+
+        # each k draws its warm-up predictions from its own seed
+        seeds = np.random.randint(0, 2**31, len(k_vals)).tolist()
+        state = (history.name, len(predictor.history), HDC.SIZE, predictor.hdc, predictor.encoding_type,
+                 predictor.window, predictor.decisions)
+        with multiprocessing.Pool(processes or min(len(k_vals), multiprocessing.cpu_count()),
+                                  initializer=init_sweep_worker, initargs=state) as pool:
+            results = pool.starmap(sweep_k, zip(k_vals, seeds))
+    finally:
+        history.close()
+        history.unlink()
+
+    all_accuracies = dict(zip(k_vals, results))
+
+    # print each final accuracy
+    for k,accuracies in all_accuracies.items():
+        print(f"k={k} accuracy={accuracies[-1]}")
+
+    # plot accuracies
+    make_plot(predictor,func=1,all_accuracies=all_accuracies)
+
+    return all_accuracies
+
+
+# shared decisions and settings for sweep_k_gram_sizes' workers
+sweep_state = None
+
+def init_sweep_worker(name,n,size,hdc,encoding_type,window,decisions):
+    global sweep_state
+    HDC.SIZE = size
+    history = shared_memory.SharedMemory(name=name)
+    sweep_state = (history, np.ndarray((n,), dtype=np.uint8, buffer=history.buf),
+                   hdc, encoding_type, window, decisions)
+
+# accuracies of a fresh predictor with k-grams of size k
+def sweep_k(k,seed):
+    _, history, hdc, encoding_type, window, decisions = sweep_state
+    predictor = branchPredictor(history,k=k,hdc=hdc,window=window,decisions=decisions)
+    predictor.encoding_type = encoding_type
+    np.random.seed(seed)
+    return predictor.test(plot=False,inplace=encoding_type != encodingType.BASELINE,results_path=None)
+
+
 # generate plot based on data 
 def make_plot(predictor,func=0,accuracies=[],all_accuracies={}):
     
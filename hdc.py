@@ -1,9 +1,25 @@
+import os
+import json
 import string
+import hashlib
+import multiprocessing
 import operator as op
 import numpy as np
 import tqdm
 import matplotlib.pyplot as plt
-from functools import reduce
+from functools import partial, reduce
+from collections import OrderedDict
+
+# population count over the last axis of an array of uint64 words
+if hasattr(np, "bitwise_count"):
+    def popcount(words):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        words = np.ascontiguousarray(words)
+        return _POPCOUNT8[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
 
 class HDC:
     SIZE = 10000
@@ -12,91 +28,916 @@ class HDC:
     # np.random.seed(seed)
     # print(f"Seed: {seed}")
 
+    # draws from rng (an np.random.Generator) when given, otherwise from the
+    # global np.random state
+    @classmethod
+    def rand_vec(cls,rng=None):
+        return cls.rand_vecs(1,rng)[0]
+
+    # n random hypervectors as rows, from raw random bytes: bit j of a row is
+    # bit j % 8 of byte j // 8 and rows are drawn whole 64 bit words at a
+    # time, so both backends draw the same hypervectors from the same stream
+    @classmethod
+    def rand_vecs(cls,n,rng=None):
+        raw = cls.rand_bytes((n, -(-cls.SIZE // 64) * 8), rng)
+        return np.unpackbits(raw, axis=-1, count=cls.SIZE, bitorder="little").astype(int)
+
     @classmethod
-    def rand_vec(cls):
-        return np.random.choice([0,1],cls.SIZE)
+    def rand_bytes(cls,shape,rng=None):
+        randint = np.random.randint if rng is None else rng.integers
+        return randint(0, 256, shape, dtype=np.uint8)
     
     @classmethod
     def dist(cls,x1,x2):
-        return op.truediv(np.sum(x1 != x2), cls.SIZE)
+        if isinstance(x1, HDRotation) or isinstance(x2, HDRotation):
+            a, shift, b, _ = align(x1, x2)
+            return op.truediv(cls.mismatches_rolled(a,shift,b), cls.SIZE)
+        return op.truediv(cls.mismatches(x1,x2), cls.SIZE)
+
+    @classmethod
+    def mismatches(cls,x1,x2):
+        return np.sum(x1 != x2)
+
+    # mismatches(roll(a,shift), b), comparing the two wrapped halves of a
+    # against b in place instead of rolling a
+    @classmethod
+    def mismatches_rolled(cls,a,shift,b):
+        n = b.shape[-1]
+        shift %= n
+        return np.count_nonzero(a[:n-shift] != b[shift:]) + np.count_nonzero(a[n-shift:] != b[:shift])
     
+    # distance of x to every row of the matrix xs
+    @classmethod
+    def dist_many(cls,xs,x):
+        return np.count_nonzero(xs != x, axis=-1) / cls.SIZE
+
+    # dist(bind(a,b), c) without materializing the bound vector
+    @classmethod
+    def dist_bind(cls,a,b,c):
+        return float(cls.dist_bind_many(np.asarray(c)[None], a, b)[0])
+
+    # distance of bind(a,b) to every row of xs in one sweep over column
+    # blocks, so only a block of the bound vector exists at any time
+    @classmethod
+    def dist_bind_many(cls,xs,a,b,block=16384):
+        if isinstance(a, HDRotation) or isinstance(b, HDRotation):
+            return cls.dist_many(xs, np.asarray(cls.bind(a,b)))
+        mismatches = np.zeros(len(xs), dtype=np.int64)
+        for lo in range(0, xs.shape[-1], block):
+            bound = np.bitwise_xor(a[lo:lo+block], b[lo:lo+block])
+            mismatches += np.count_nonzero(xs[:, lo:lo+block] != bound, axis=1)
+        return mismatches / cls.SIZE
+
+    # distance of every row of xs1 to every row of xs2. on 0/1 vectors the
+    # hamming distance is |a| + |b| - 2 a.b, so this is a single matmul
+    # (float32 is exact here as long as SIZE < 2**24).
+    @classmethod
+    def dist_matrix(cls,xs1,xs2):
+        a = np.asarray(xs1, dtype=np.float32)
+        b = np.asarray(xs2, dtype=np.float32)
+        ham = a.sum(axis=1)[:,None] + b.sum(axis=1)[None,:] - 2 * (a @ b.T)
+        return ham.astype(np.float64) / cls.SIZE
+
+    # rows of (queries, items) per dist_matrix tile so that its temporaries
+    # take about nbytes. each operand of the matmul gets its own budget, and
+    # so does the rows x rows output, which is built in float32 and copied to
+    # float64 (about 24 bytes per entry) and dominates when SIZE is small.
+    @classmethod
+    def tile_shape(cls,width,nbytes):
+        rows = max(1, min(nbytes // (4 * width), int(np.sqrt(nbytes // 24))))
+        return rows, rows
+
+    # binding commutes with rotation, so binding two lazy rotations only rolls
+    # one operand relative to the other and keeps the common shift lazy
     @classmethod
     def bind(cls,x1,x2):
+        if isinstance(x1, HDRotation) or isinstance(x2, HDRotation):
+            a, shift, b, common = align(x1, x2)
+            bound = cls.bind_rolled(a,shift,b) if shift % cls.SIZE else np.bitwise_xor(a,b)
+            return cls.rotate(bound,common) if common % cls.SIZE else bound
         return np.bitwise_xor(x1,x2)
 
+    # bind(roll(a,shift), b), xoring the two wrapped halves straight into
+    # the output instead of rolling a
+    @classmethod
+    def bind_rolled(cls,a,shift,b):
+        n = b.shape[-1]
+        shift %= n
+        out = np.empty(n, dtype=np.result_type(a,b))
+        np.bitwise_xor(a[:n-shift], b[shift:], out=out[shift:])
+        np.bitwise_xor(a[n-shift:], b[:shift], out=out[:shift])
+        return out
+
     @classmethod
     def bind_all(cls, xs):
-        return reduce(HDC.bind,xs)
+        return reduce(cls.bind,xs)
 
     @classmethod
     def bundle(cls,xs):
+        if any(isinstance(x, HDRotation) for x in xs):
+            return (cls.bundle_counts(xs) > (len(xs)/2)).astype(int)
         # if entry = thr, entry = 0 always
         return (np.sum(xs,axis=0) > (len(xs)/2)).astype(int)
+
+    # per-position sums of xs
+    @classmethod
+    def bundle_counts(cls,xs):
+        counts = np.zeros(cls.SIZE, dtype=np.int64)
+        for x in xs:
+            cls.accumulate(counts,x)
+        return counts
+
+    # counts += weight * x in place; lazy rotations are added half by half
+    @classmethod
+    def accumulate(cls,counts,x,weight=1):
+        if isinstance(x, HDRotation):
+            n = cls.SIZE - x.shift
+            cls.accumulate(counts[x.shift:], x.base[:n], weight)
+            cls.accumulate(counts[:x.shift], x.base[n:], weight)
+        elif weight == 1:
+            np.add(counts, x, out=counts, casting="unsafe")
+        elif weight == -1:
+            np.subtract(counts, x, out=counts, casting="unsafe")
+        else:
+            np.add(counts, np.multiply(x, weight, dtype=counts.dtype), out=counts)
           
     @classmethod
     def permute(cls,x,i):
-        return np.roll(x,i)
+        if isinstance(x, HDRotation):
+            return np.roll(x.base, x.shift + i, axis=-1)
+        return np.roll(x,i,axis=-1)
+
+    # lazy permute: records the offset instead of copying (see HDRotation)
+    @classmethod
+    def rotate(cls,x,i):
+        if isinstance(x, HDRotation):
+            return HDRotation(x.base, x.shift + i, cls)
+        return HDRotation(x, i, cls)
+
+    # values of the given bit positions of each hypervector in xs
+    @classmethod
+    def sample_bits(cls,xs,positions):
+        return np.asarray(xs)[..., positions]
+
+    # unpacked 0/1 view of a hypervector (identity for this backend)
+    @classmethod
+    def to_bits(cls,x):
+        return x
+
+    # x as an array in this backend's representation, for rows stored in an
+    # item memory (see PackedBitsHDC)
+    @classmethod
+    def coerce(cls,x):
+        return np.asarray(x)
+
+    @classmethod
+    def from_bits(cls,bits):
+        return bits
     
 
+# packed backend: a hypervector is stored as ceil(SIZE/64) uint64 words, bit j
+# of the hypervector being bit (j % 64) of word (j // 64). padding bits in the
+# last word are always zero, so xor keeps them zero and popcount ignores them.
+class PackedHDC(HDC):
+
+    @classmethod
+    def words(cls):
+        return -(-cls.SIZE // 64)
+
+    # mask of the valid bits in the last word
+    @classmethod
+    def tail_mask(cls):
+        rem = cls.SIZE % 64
+        return np.uint64((1 << rem) - 1) if rem else np.uint64(2**64 - 1)
+
+    @classmethod
+    def pack(cls,x):
+        bits = np.asarray(x).astype(np.uint8, copy=False)
+        packed = np.packbits(bits, axis=-1, bitorder="little")
+        pad = cls.words() * 8 - packed.shape[-1]
+        if pad:
+            packed = np.concatenate(
+                [packed, np.zeros(packed.shape[:-1] + (pad,), dtype=np.uint8)], axis=-1)
+        return np.ascontiguousarray(packed).view("<u8").astype(np.uint64, copy=False)
+
+    @classmethod
+    def unpack(cls,words):
+        as_bytes = np.ascontiguousarray(words, dtype="<u8").view(np.uint8)
+        bits = np.unpackbits(as_bytes, axis=-1, count=cls.SIZE, bitorder="little")
+        return bits.astype(int)
+
+    @classmethod
+    def accumulate(cls,counts,x,weight=1):
+        HDC.accumulate(counts, cls.unpack(x), weight)
+
+    @classmethod
+    def sample_bits(cls,xs,positions):
+        words = np.asarray(xs)[..., positions // 64]
+        return (words >> (positions % 64).astype(np.uint64)) & np.uint64(1)
+
+    @classmethod
+    def to_bits(cls,x):
+        return cls.unpack(x)
+
+    @classmethod
+    def from_bits(cls,bits):
+        return cls.pack(bits)
+
+    @classmethod
+    def rand_vecs(cls,n,rng=None):
+        words = cls.rand_bytes((n, cls.words() * 8), rng).view("<u8").astype(np.uint64, copy=False)
+        words[:, -1] &= cls.tail_mask()
+        return words
+
+    @classmethod
+    def mismatches(cls,x1,x2):
+        return int(popcount(np.bitwise_xor(x1,x2)))
+
+    # packed rotations are word shifts, so rolled operands are just rotated
+    @classmethod
+    def mismatches_rolled(cls,a,shift,b):
+        return cls.mismatches(cls.permute(a,shift), b)
+
+    @classmethod
+    def bind_rolled(cls,a,shift,b):
+        return np.bitwise_xor(cls.permute(a,shift), b)
+
+    @classmethod
+    def dist_many(cls,xs,x):
+        return popcount(np.bitwise_xor(xs,x)) / cls.SIZE
+
+    # xor-xor-popcount: the bound query is only ceil(SIZE/64) words
+    @classmethod
+    def dist_bind_many(cls,xs,a,b,block=None):
+        bound = np.bitwise_xor(np.asarray(a), np.asarray(b))
+        return popcount(np.bitwise_xor(xs, bound)) / cls.SIZE
+
+    @classmethod
+    def dist_matrix(cls,xs1,xs2):
+        xs1 = np.asarray(xs1)
+        xs2 = np.asarray(xs2)
+        return popcount(np.bitwise_xor(xs1[:,None,:], xs2[None,:,:])) / cls.SIZE
+
+    @classmethod
+    def tile_shape(cls,width,nbytes):
+        rows = max(1, int(np.sqrt(nbytes // (8 * width))))
+        return rows, rows
+
+    @classmethod
+    def bundle(cls,xs):
+        return cls.pack(HDC.bundle(cls.unpack(np.asarray([np.asarray(x) for x in xs]))))
+
+    # rotate the SIZE-bit ring by i, i.e. np.roll on the unpacked vector.
+    # done as (x << i) | (x >> (SIZE - i)) on the multi-word integer.
+    @classmethod
+    def permute(cls,x,i):
+        if isinstance(x, HDRotation):
+            x, i = x.base, x.shift + i
+        i %= cls.SIZE
+        if i == 0:
+            return np.array(x)
+        out = cls._shift_left(x, i)
+        out |= cls._shift_right(x, cls.SIZE - i)
+        out[..., -1] &= cls.tail_mask()
+        return out
+
+    @classmethod
+    def _shift_left(cls,x,s):
+        n = x.shape[-1]
+        q, r = divmod(s, 64)
+        out = np.zeros_like(x)
+        if q < n:
+            out[..., q:] = x[..., :n-q] << np.uint64(r)
+            if r and q + 1 < n:
+                out[..., q+1:] |= x[..., :n-q-1] >> np.uint64(64 - r)
+        return out
+
+    @classmethod
+    def _shift_right(cls,x,s):
+        n = x.shape[-1]
+        q, r = divmod(s, 64)
+        out = np.zeros_like(x)
+        if q < n:
+            out[..., :n-q] = x[..., q:] >> np.uint64(r)
+            if r and q + 1 < n:
+                out[..., :n-q-1] |= x[..., q+1:] << np.uint64(64 - r)
+        return out
+
+
+# packed backend for memories loaded from an unpacked (HDC) save: operands
+# given as unpacked 0/1 bits are packed on the way in, so HDC hypervectors can
+# be added to, searched against and tracked over the packed rows directly
+class PackedBitsHDC(PackedHDC):
+
+    @classmethod
+    def coerce(cls,x):
+        x = np.asarray(x)
+        return x if x.dtype == np.uint64 else cls.pack(x)
+
+    @classmethod
+    def to_bits(cls,x):
+        return super().to_bits(cls.coerce(x))
+
+    @classmethod
+    def sample_bits(cls,xs,positions):
+        return super().sample_bits(cls.coerce(xs), positions)
+
+    @classmethod
+    def dist(cls,x1,x2):
+        return super().dist(cls.coerce(x1), cls.coerce(x2))
+
+    @classmethod
+    def dist_many(cls,xs,x):
+        return super().dist_many(xs, cls.coerce(x))
+
+    @classmethod
+    def dist_bind_many(cls,xs,a,b,block=None):
+        return super().dist_bind_many(xs, cls.coerce(a), cls.coerce(b))
+
+    @classmethod
+    def dist_matrix(cls,xs1,xs2):
+        return super().dist_matrix(cls.coerce(xs1), cls.coerce(xs2))
+
+
+# a hypervector permuted by `shift` without materializing the roll: element j
+# is base[(j - shift) % SIZE]. HDC.bind, dist and bundle consume the offset
+# directly; anything else sees the rolled array through np.asarray.
+class HDRotation:
+
+    def __init__(self,base,shift,hdc=HDC) -> None:
+        self.base = base
+        self.shift = shift % hdc.SIZE
+        self.hdc = hdc
+
+    def __array__(self,dtype=None,copy=None):
+        rolled = self.hdc.permute(self.base,self.shift)
+        return rolled if dtype is None else rolled.astype(dtype)
+
+
+# split a pair of hypervectors, either of which may be a lazy rotation, into
+# (a, shift, b, common) so that x1 = roll(a, shift + common) and
+# x2 = roll(b, common)
+def align(x1,x2):
+    a, s1 = (x1.base, x1.shift) if isinstance(x1, HDRotation) else (x1, 0)
+    b, s2 = (x2.base, x2.shift) if isinstance(x2, HDRotation) else (x2, 0)
+    return a, s1 - s2, b, s2
+
+
+# streaming bundle. counts[j] is the total weight of the added hypervectors
+# with bit j set, kept in compact integer counters; the bundle (counts above
+# half the total weight) is only thresholded when read. ties, which
+# HDC.bundle always resolves to 0, follow `tie`: "zero", "one" or "random".
+class BundleAccumulator:
+
+    def __init__(self,hdc=HDC,dtype=np.int32,tie="zero",seed=None) -> None:
+        assert(tie in ("zero", "one", "random"))
+        self.hdc = hdc
+        self.tie = tie
+        self.rng = np.random.default_rng(seed)
+        self.counts = np.zeros(hdc.SIZE, dtype=dtype)
+        self.total = 0
+
+        # bounds on the counters, for overflow detection
+        self.lo = 0
+        self.hi = 0
+
+        # thresholded bundle, computed on read
+        self.result = None
+
+    def __len__(self):
+        return self.total
+
+    # bits=True takes hv as already unpacked 0/1 bits, whatever the backend
+    def add(self,hv,weight=1,bits=False):
+        assert(weight == int(weight))
+        weight = int(weight)
+        self.check(weight,hv,bits)
+        (HDC if bits else self.hdc).accumulate(self.counts, hv, weight)
+        self.total += weight
+        self.result = None
+
+    def subtract(self,hv,weight=1,bits=False):
+        self.add(hv,-weight,bits)
+
+    # raise OverflowError if adding weight * hv would push a counter out of
+    # range. the running bounds only ever widen, so tighten them from the
+    # counters before giving up, and then only look at the counters under
+    # the set bits of hv, the only ones that move.
+    def check(self,weight,hv=None,bits=False):
+        info = np.iinfo(self.counts.dtype)
+        lo, hi = self.lo + min(weight, 0), self.hi + max(weight, 0)
+        if lo < info.min or hi > info.max:
+            self.lo, self.hi = int(self.counts.min()), int(self.counts.max())
+            lo, hi = self.lo + min(weight, 0), self.hi + max(weight, 0)
+            if (lo < info.min or hi > info.max) and hv is not None:
+                hv = np.asarray(hv)
+                moved = self.counts[np.asarray(hv if bits else self.hdc.to_bits(hv), dtype=bool)]
+                lo, hi = self.lo, self.hi
+                if len(moved):
+                    lo = min(lo, int(moved.min()) + min(weight, 0))
+                    hi = max(hi, int(moved.max()) + max(weight, 0))
+            if lo < info.min or hi > info.max:
+                raise OverflowError(f"bundle counters overflow {self.counts.dtype}")
+        self.lo, self.hi = lo, hi
+
+    # thresholded bundle of everything added so far
+    def value(self):
+        if self.result is None:
+            thr = self.total / 2
+            bits = self.counts > thr
+            if self.tie == "one":
+                bits |= self.counts == thr
+            elif self.tie == "random":
+                ties = np.flatnonzero(self.counts == thr)
+                bits[ties] = self.rng.integers(0, 2, len(ties))
+            self.result = self.hdc.from_bits(bits.astype(int))
+        return self.result
+
+    # threshold into a preallocated boolean array, leaving value()'s cache
+    # alone. only the "random" tie policy allocates.
+    def value_into(self,out):
+        # integer thresholds keep the comparison in the counters' dtype:
+        # c > t/2 is c > t//2 and c >= t/2 is c >= ceil(t/2)
+        if self.tie == "one":
+            return np.greater_equal(self.counts, -(-self.total // 2), out=out)
+        np.greater(self.counts, self.total // 2, out=out)
+        # ties only exist for an even total; counts * 2 could overflow
+        if self.tie == "random" and self.total % 2 == 0:
+            ties = np.flatnonzero(self.counts == self.total // 2)
+            out[ties] = self.rng.integers(0, 2, len(ties))
+        return out
+
+    def clear(self):
+        self.counts[:] = 0
+        self.total = 0
+        self.lo = 0
+        self.hi = 0
+        self.result = None
+
+
 class HDItemMem:
+    BLOCK_BYTES = 1 << 22
 
-    def __init__(self,name=None) -> None:
+    def __init__(self,name=None,hdc=HDC) -> None:
         self.name = name
-        self.item_mem = {}
+        self.hdc = hdc
+
+        # hypervectors are the first `count` rows of one contiguous matrix,
+        # `index` maps each key to its row
+        self.keys = []
+        self.index = {}
+        self.vecs = None
+        self.count = 0
+
+        # optional approximate nearest neighbour index (see HDLSHIndex)
+        self.ann = None
 
     def add(self,key,hv):
         assert(not hv is None)
-        self.item_mem[key] = hv
+        hv = self.hdc.coerce(hv)
+        self.materialize()
+        row = self.index.get(key)
+        if row is None:
+            row = self.count
+            self.reserve(row + 1, hv)
+            self.keys.append(key)
+            self.index[key] = row
+            self.count += 1
+        elif self.ann is not None:
+            self.ann.remove(row, self.vecs[row])
+        self.vecs[row] = hv
+        if self.ann is not None:
+            self.ann.add(row, hv)
+
+    # attach an approximate index; wta and topk then only re-rank its
+    # candidates unless called with exact=True
+    def attach_index(self,ann):
+        self.ann = ann
+        ann.attach(self)
+
+    # add many new keys at once, hvs holding one row per key. with
+    # copy=False an empty memory takes hvs over as its storage
+    def add_many(self,keys,hvs,copy=True):
+        keys = list(keys)
+        hvs = self.hdc.coerce(hvs)
+        assert(len(keys) == len(hvs))
+        if len(set(keys)) < len(keys) or any(key in self.index for key in keys):
+            for key, hv in zip(keys, hvs):
+                HDItemMem.add(self, key, hv)
+            return
+        if not keys:
+            return
+
+        self.materialize()
+        start = self.count
+        if self.vecs is None and not copy:
+            self.vecs = hvs
+        else:
+            self.reserve(start + len(keys), hvs[0])
+            self.vecs[start:start + len(keys)] = hvs
+        self.keys.extend(keys)
+        self.index.update(zip(keys, range(start, start + len(keys))))
+        self.count += len(keys)
+        if self.ann is not None:
+            for row in range(start, self.count):
+                self.ann.add(row, self.vecs[row])
+
+    # make room for at least n rows shaped like hv, doubling capacity
+    def reserve(self,n,hv):
+        if self.vecs is None:
+            self.vecs = np.empty((max(n, 16),) + hv.shape, dtype=hv.dtype)
+        elif n > len(self.vecs):
+            vecs = np.empty((max(n, 2 * len(self.vecs)),) + self.vecs.shape[1:], dtype=self.vecs.dtype)
+            vecs[:self.count] = self.vecs[:self.count]
+            self.vecs = vecs
     
+    # a loaded memory maps its file read-only; writing copies it into memory
+    def materialize(self):
+        if self.vecs is not None and not self.vecs.flags.writeable:
+            self.vecs = np.array(self.vecs[:self.count])
+
     def get(self,key):
-        return self.item_mem[key]
+        return self.vecs[self.index[key]]
 
     def has(self,key):
-        return key in self.item_mem
+        return key in self.index
+
+    def __len__(self):
+        return self.count
+
+    # matrix of the stored hypervectors, one row per key in insertion order
+    def matrix(self):
+        if self.vecs is None:
+            return np.empty((0, 0))
+        return self.vecs[:self.count]
+
+    # rows per block so a block of the matrix takes about BLOCK_BYTES
+    def block_rows(self):
+        return max(1, self.BLOCK_BYTES // self.vecs[0].nbytes)
+
+    # fxn(rows) over the whole matrix, one block at a time when it spans
+    # several, so a memory mapped matrix larger than RAM is streamed
+    def scan(self,fxn):
+        if self.count == 0:
+            return np.empty(0)
+        rows = self.block_rows()
+        if self.count <= rows:
+            return fxn(self.matrix())
+        return np.concatenate([fxn(block) for _, block in self.blocks(rows)])
+
+    # distances of the query to every row, in key order
+    def distance_array(self,query):
+        return self.scan(lambda block: self.hdc.dist_many(block, query))
 
     def distance(self,query):
-        return {key: HDC.dist(val,query) for key,val in self.item_mem.items()}
+        return dict(zip(self.keys, self.distance_array(query).tolist()))
+
+    # yield (first row, block of rows) over the stored matrix
+    def blocks(self,rows):
+        mat = self.matrix()
+        for start in range(0, self.count, rows):
+            yield start, mat[start:start+rows]
+
+    # yield (query slice, first row, distance tile) covering queries x items.
+    # tiles are sized by BLOCK_BYTES so temporaries stay cache sized.
+    def tiles(self,queries):
+        q_rows, x_rows = self.hdc.tile_shape(queries.shape[-1], self.BLOCK_BYTES)
+        for start, block in self.blocks(x_rows):
+            for q_start in range(0, len(queries), q_rows):
+                q_slice = slice(q_start, q_start + q_rows)
+                yield q_slice, start, self.hdc.dist_matrix(queries[q_slice], block)
+
+    # distance matrix of shape (n_queries, len(self)) for an (n_queries, width)
+    # array of queries
+    def distance_batch(self,queries):
+        queries = self.hdc.coerce(np.atleast_2d(queries))
+        dists = np.empty((len(queries), self.count))
+        for q_slice, start, tile in self.tiles(queries):
+            dists[q_slice, start:start+tile.shape[1]] = tile
+        return dists
+
+    # winning key for each query, without materializing the distance matrix
+    def wta_batch(self,queries):
+        queries = self.hdc.coerce(np.atleast_2d(queries))
+        best = np.full(len(queries), np.inf)
+        best_row = np.zeros(len(queries), dtype=np.int64)
+        for q_slice, start, tile in self.tiles(queries):
+            rows = np.argmin(tile, axis=1)
+            tile_best = tile[np.arange(len(rows)), rows]
+            better = tile_best < best[q_slice]
+            best[q_slice] = np.where(better, tile_best, best[q_slice])
+            best_row[q_slice] = np.where(better, rows + start, best_row[q_slice])
+        return [self.keys[row] for row in best_row.tolist()]
+
+    # hypervectors of the given rows
+    def take(self,rows):
+        return self.matrix()[rows]
 
     def all_keys(self):
-        return list(self.item_mem.keys())
+        return list(self.keys)
 
     def all_hvs(self):
-        return list(self.item_mem.values())
+        return list(self.matrix())
+
+    # write the memory to the directory path: the rows as a packed bit matrix
+    # (vecs.npy, one row of uint64 words per key) and the keys and metadata
+    # as json (keys.json). rows are packed a block at a time into a temporary
+    # file that then replaces vecs.npy, so saving a loaded memory over its own
+    # directory never truncates the file its rows are mapped from.
+    def save(self,path):
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, "vecs.tmp.npy")
+        vecs = np.lib.format.open_memmap(tmp_path, mode="w+",
+                                         dtype=np.uint64, shape=(self.count, PackedHDC.words()))
+        if self.count:
+            packed = issubclass(self.hdc, PackedHDC)
+            for start, block in self.blocks(self.block_rows()):
+                vecs[start:start+len(block)] = block if packed else PackedHDC.pack(block)
+        vecs.flush()
+        del vecs
+        os.replace(tmp_path, os.path.join(path, "vecs.npy"))
 
-    def wta(self,query):
-        dists = self.distance(query)
-        return min(dists, key=dists.get)
+        meta = {"name": self.name, "size": self.hdc.SIZE, "hdc": self.hdc.__name__,
+                "codebook": isinstance(self, HDCodebook), "keys": self.keys}
+        with open(os.path.join(path, "keys.json"), "w") as f:
+            json.dump(meta, f)
+
+    # rows to search for the query and their distances: the index candidates
+    # when an index is attached, otherwise (or when it finds none) every row
+    def search(self,query,exact=False):
+        if self.ann is not None and not exact:
+            rows = self.ann.candidates(query)
+            if len(rows):
+                return rows, self.hdc.dist_many(self.take(rows), query)
+        return np.arange(self.count), self.distance_array(query)
+
+    # distances of bind(a,b) to every row, without building bind(a,b)
+    def distance_bind(self,a,b):
+        return self.scan(lambda block: self.hdc.dist_bind_many(block, a, b))
+
+    def wta_bind(self,a,b):
+        return self.keys[int(np.argmin(self.distance_bind(a,b)))]
+
+    def wta(self,query,exact=False):
+        rows, dists = self.search(query, exact)
+        return self.keys[int(rows[np.argmin(dists)])]
     
     def matches(self,query, thr=0.49):
-        dists = self.distance(query)
-        return {key: val for key,val in dists.items() if val <= thr}
+        dists = self.distance_array(query)
+        return {self.keys[row]: dists[row] for row in np.flatnonzero(dists <= thr).tolist()}
+
+    # k nearest keys to the query and their distances, closest first, plus the
+    # margin between the winner and the runner-up (None with fewer than two
+    # items). only the k best rows are sorted, the rest is partitioned away.
+    def topk(self,query,k=2,exact=False):
+        rows, dists = self.search(query, exact)
+        k = min(k, len(dists))
+        order = np.arange(len(dists))
+        if k < len(dists):
+            # keep every row tied with the k-th distance so ties break by row
+            kth = dists[np.argpartition(dists, k - 1)[k - 1]]
+            order = np.flatnonzero(dists <= kth)
+        order = order[np.lexsort((rows[order], dists[order]))][:k]
+        best = dists[order]
+        margin = float(best[1] - best[0]) if k >= 2 else None
+        return [self.keys[row] for row in rows[order].tolist()], best, margin
         
 
+# approximate nearest neighbour index over an item memory (bit-sampling lsh).
+# each of `tables` hash tables buckets rows by the values of `bits` randomly
+# chosen bit positions. rows sharing a bucket with the query in any table are
+# the candidates that the item memory then re-ranks exactly. a row at
+# distance d collides in one table with probability (1-d)**bits, so more
+# tables raise recall and more bits shrink the buckets (faster, lower recall).
+class HDLSHIndex:
+
+    def __init__(self,tables=16,bits=16,seed=None) -> None:
+        assert(0 < bits < 63)
+        self.tables = tables
+        self.bits = bits
+        self.rng = np.random.default_rng(seed)
+        self.mem = None
+        self.positions = None
+        self.buckets = []
+
+    # pick the sampled bit positions and hash every row already in mem
+    def attach(self,mem):
+        self.mem = mem
+        self.positions = np.array([self.rng.choice(mem.hdc.SIZE, self.bits, replace=False)
+                                   for _ in range(self.tables)])
+        self.buckets = [{} for _ in range(self.tables)]
+        for start, block in mem.blocks(4096):
+            for offset, codes in enumerate(self.hash(block).tolist()):
+                for bucket, code in zip(self.buckets, codes):
+                    bucket.setdefault(code, []).append(start + offset)
+
+    # (n, tables) bucket codes for an (n, width) array of hypervectors
+    def hash(self,xs):
+        xs = np.atleast_2d(xs)
+        sampled = self.mem.hdc.sample_bits(xs, self.positions.ravel())
+        sampled = sampled.reshape(len(xs), self.tables, self.bits).astype(np.int64)
+        return sampled @ (np.int64(1) << np.arange(self.bits, dtype=np.int64))
+
+    def add(self,row,hv):
+        for bucket, code in zip(self.buckets, self.hash(hv)[0].tolist()):
+            bucket.setdefault(code, []).append(row)
+
+    def remove(self,row,hv):
+        for bucket, code in zip(self.buckets, self.hash(hv)[0].tolist()):
+            bucket[code].remove(row)
+
+    # sorted array of candidate rows for the query
+    def candidates(self,query):
+        found = [bucket.get(code, []) for bucket, code in zip(self.buckets, self.hash(query)[0].tolist())]
+        return np.unique(np.fromiter((row for rows in found for row in rows), dtype=np.int64))
+
+
+# tracks the hamming distances of a changing 0/1 vector x to every row of an
+# item memory. flipping some positions of x only revisits those columns, so
+# an update costs O(changes * rows) instead of a full rescan.
+class HDDistanceTracker:
+
+    def __init__(self,mem) -> None:
+        self.mem = mem
+        self.rows = mem.hdc.to_bits(mem.matrix()).astype(bool)
+        self.x = None
+        self.mismatches = None
+
+    # start tracking x (a hypervector of the memory's backend) from scratch
+    def reset(self,x):
+        self.x = np.array(self.mem.hdc.to_bits(x), dtype=bool)
+        self.mismatches = np.count_nonzero(self.rows != self.x, axis=1)
+
+    # move x to new 0/1 bits, revisiting only the positions that changed.
+    # when most positions changed a dense rescan is cheaper than gathering.
+    def update(self,bits):
+        positions = np.flatnonzero(self.x != bits)
+        if len(positions) > len(self.x) // 8:
+            self.x[:] = bits
+            self.mismatches = np.count_nonzero(self.rows != self.x, axis=1)
+        else:
+            self.flip(positions)
+        return positions
+
+    # flip x at the given (distinct) positions
+    def flip(self,positions):
+        # each flipped position that mismatched a row now matches it, and the
+        # other way round
+        was = np.count_nonzero(self.rows[:, positions] != self.x[positions], axis=1)
+        self.mismatches += len(positions) - 2 * was
+        self.x[positions] ^= True
+
+    def distances(self):
+        return self.mismatches / self.mem.hdc.SIZE
+
+    def wta(self):
+        return self.mem.keys[int(np.argmin(self.mismatches))]
+
+
 # a codebook is simply an item memory that always creates a random hypervector
 # when a key is added.
 class HDCodebook(HDItemMem):
 
-    def __init__(self,name=None):
-        HDItemMem.__init__(self,name)
+    # rng: np.random.Generator or seed to draw from (default: global np.random)
+    def __init__(self,name=None,hdc=HDC,rng=None):
+        HDItemMem.__init__(self,name,hdc)
+        self.rng = rng if rng is None else np.random.default_rng(rng)
 
     def add(self,key):
-        self.item_mem[key] = HDC.rand_vec()
+        HDItemMem.add(self,key,self.hdc.rand_vec(self.rng))
+
+    # draw and add hypervectors for all keys in one call
+    def add_many(self,keys):
+        keys = list(keys)
+        HDItemMem.add_many(self,keys,self.hdc.rand_vecs(len(keys),self.rng),copy=False)
     
 
-def make_letter_hvs():
-    letter_cb = HDCodebook()
-    for letter in string.ascii_letters:
-        letter_cb.add(letter)
+# a codebook that stores no hypervectors: each key's hypervector is drawn from
+# a generator seeded by a stable hash of the key and the codebook seed, so it
+# is the same in every process and run and workers can rebuild the codebook
+# from its keys and seed alone. the cache_size most recently used vectors are
+# kept, anything else (including every block of a search) is regenerated.
+# keys must have a stable repr (strings, ints and tuples of them).
+class HDSeededCodebook(HDCodebook):
+
+    def __init__(self,name=None,hdc=HDC,seed=None,cache_size=1024):
+        HDCodebook.__init__(self,name,hdc)
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    # builtin hash() of a string is salted per process, blake2b is not
+    def key_seed(self,key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        return np.random.SeedSequence([int.from_bytes(digest, "little"), self.seed])
+
+    def generate(self,key):
+        return self.hdc.rand_vec(np.random.default_rng(self.key_seed(key)))
+
+    # adding a key only registers it, its hypervector never changes
+    def add(self,key):
+        if key in self.index:
+            return
+        self.index[key] = self.count
+        self.keys.append(key)
+        self.count += 1
+        if self.ann is not None:
+            self.ann.add(self.count - 1, self.generate(key))
+
+    def add_many(self,keys):
+        for key in keys:
+            self.add(key)
+
+    def get(self,key):
+        assert(key in self.index)
+        hv = self.cache.get(key)
+        if hv is None:
+            hv = self.generate(key)
+            self.cache[key] = hv
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return hv
+
+    def take(self,rows):
+        return np.array([self.generate(self.keys[row]) for row in np.asarray(rows).tolist()])
+
+    def matrix(self):
+        if self.count == 0:
+            return np.empty((0, 0))
+        return self.take(range(self.count))
+
+    # regenerated blocks, bypassing the cache so a scan does not flush it
+    def blocks(self,rows):
+        for start in range(0, self.count, rows):
+            yield start, self.take(range(start, min(start + rows, self.count)))
+
+    def block_rows(self):
+        return max(1, self.BLOCK_BYTES // self.generate(self.keys[0]).nbytes)
+
+    # the cache is rebuilt on demand, so it is not pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict()
+        return state
+
+
+# open a memory written by HDItemMem.save. the rows are memory mapped (pass
+# mmap_mode=None to read them into memory instead), so opening is immediate,
+# processes share the pages and searches stream the file block by block. rows
+# stay packed: memories saved from HDC get PackedBitsHDC, which still accepts
+# unpacked queries. json turns tuple keys into lists, they are turned back.
+def load_item_mem(path,mmap_mode="r"):
+    with open(os.path.join(path, "keys.json")) as f:
+        meta = json.load(f)
+    assert(meta["size"] == HDC.SIZE)
+
+    def key_of(key):
+        return tuple(map(key_of, key)) if isinstance(key, list) else key
+
+    hdc = PackedHDC if meta["hdc"] == "PackedHDC" else PackedBitsHDC
+    mem = HDCodebook(meta["name"], hdc) if meta["codebook"] else HDItemMem(meta["name"], hdc)
+    mem.keys = [key_of(key) for key in meta["keys"]]
+    mem.index = {key: row for row, key in enumerate(mem.keys)}
+    mem.count = len(mem.keys)
+    if mem.count:
+        mem.vecs = np.load(os.path.join(path, "vecs.npy"), mmap_mode=mmap_mode)
+    return mem
+
+
+def make_letter_hvs(hdc=HDC,rng=None):
+    letter_cb = HDCodebook(hdc=hdc,rng=rng)
+    letter_cb.add_many(string.ascii_letters)
     return letter_cb
     
 def make_word(letter_cb, word):
+    hdc = letter_cb.hdc
     letter_hvs = [letter_cb.get(letter) for letter in word]
-    return HDC.bundle([HDC.permute(letter_hvs[i],i) for i in range(len(word))])
+    return hdc.bundle([hdc.rotate(letter_hvs[i],i) for i in range(len(word))])
     
 def monte_carlo(fxn,trials):
     results = list(map(lambda i: fxn(), tqdm.tqdm(range(trials))))
     return results
 
+# monte_carlo over a process pool. fxn(rng) is called once per trial with
+# its own np.random.Generator, all spawned from one SeedSequence, and the
+# results come back in trial order: they depend on the seed only, not on
+# the number of processes. fxn must be picklable (a module-level function
+# or a functools.partial of one).
+def monte_carlo_parallel(fxn,trials,seed=None,processes=None):
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, trials // (4 * processes))
+    with multiprocessing.Pool(processes) as pool:
+        trial = partial(run_trial, fxn, HDC.SIZE)
+        return list(tqdm.tqdm(pool.imap(trial, seed.spawn(trials), chunksize=chunksize), total=trials))
+
+def run_trial(fxn,size,seed):
+    HDC.SIZE = size
+    return fxn(np.random.default_rng(seed))
+
 def plot_dist_distributions(key1, dist1, key2, dist2):
     plt.hist(dist1,  
             alpha=0.75, 
@@ -111,22 +952,66 @@ def plot_dist_distributions(key1, dist1, key2, dist2):
     plt.show()
     plt.clf()
 
-def study_distributions():
-    def gen_codebook_and_words(w1,w2,prob_error=0.0):
-        cb = make_letter_hvs()
-        w1_hv = make_word(cb,w1)
-        w2_hv = make_word(cb,w2)
-        return HDC.dist(w1_hv,w2_hv)
+def gen_codebook_and_words(w1,w2,rng=None,prob_error=0.0):
+    cb = make_letter_hvs(rng=rng)
+    w1_hv = make_word(cb,w1)
+    w2_hv = make_word(cb,w2)
+    return HDC.dist(w1_hv,w2_hv)
+
+# distance between the words w1 and w2 under each of a batch of letter
+# codebooks, given as (T, 52, ceil(SIZE/8)) packed bytes (bit j of a letter
+# is bit j % 8 of byte j // 8, rows in string.ascii_letters order). the same
+# encoding as make_word, but for all T codebooks at once: the letters are
+# gathered, unpacked, rolled by gather indexing and bundled in one go.
+def word_distances(codebooks,w1,w2):
+    def encode(word):
+        rows = [string.ascii_letters.index(letter) for letter in word]
+        bits = np.unpackbits(codebooks[:, rows], axis=-1, count=HDC.SIZE, bitorder="little")
+
+        # letter i is permuted by i: element j comes from (j - i) % SIZE
+        rolled = (np.arange(HDC.SIZE)[None, :] - np.arange(len(word))[:, None]) % HDC.SIZE
+        bits = np.take_along_axis(bits, rolled[None], axis=-1)
+
+        # if entry = thr, entry = 0 always
+        return bits.sum(axis=1, dtype=np.int32) > (len(word) / 2)
+
+    return np.count_nonzero(encode(w1) != encode(w2), axis=-1) / HDC.SIZE
+
+# distances between w1 and w2 over `trials` random letter codebooks, drawn
+# from rng (a Generator or seed) as packed random bytes in chunks of about
+# chunk_bytes
+def batch_word_distances(w1,w2,trials,rng=None,chunk_bytes=1 << 26):
+    rng = np.random.default_rng(rng)
+    row_bytes = -(-HDC.SIZE // 8)
+    trial_bytes = len(string.ascii_letters) * row_bytes + (len(w1) + len(w2)) * HDC.SIZE * 2
+    chunk = max(1, chunk_bytes // trial_bytes)
+
+    dists = []
+    for start in range(0, trials, chunk):
+        shape = (min(chunk, trials - start), len(string.ascii_letters), row_bytes)
+        codebooks = rng.integers(0, 256, shape, dtype=np.uint8)
+        dists.append(word_distances(codebooks, w1, w2))
+    return np.concatenate(dists).tolist() if dists else []
+
+def study_distributions(seed=None,batched=True):
+    # one independent stream per study
+    seeds = np.random.SeedSequence(seed).spawn(4)
 
+    # every trial draws a fresh codebook, either all at once as arrays or
+    # one trial at a time across processes
+    def trials_of(w1,w2,trials,seed,prob_error=0.0):
+        if batched:
+            return batch_word_distances(w1,w2,trials,np.random.default_rng(seed))
+        return monte_carlo_parallel(partial(gen_codebook_and_words,w1,w2,prob_error=prob_error), trials, seed)
 
     trials = 1000
-    d1 = monte_carlo(lambda: gen_codebook_and_words("fox","box"), trials)
-    d2 = monte_carlo(lambda: gen_codebook_and_words("fox","car"), trials)
+    d1 = trials_of("fox","box", trials, seeds[0])
+    d2 = trials_of("fox","car", trials, seeds[1])
     plot_dist_distributions("box",d1,"car",d2)
 
     perr = 0.10
-    d1 = monte_carlo(lambda: gen_codebook_and_words("fox","box", prob_error=perr), trials)
-    d2 = monte_carlo(lambda: gen_codebook_and_words("fox","car", prob_error=perr), trials)
+    d1 = trials_of("fox","box", trials, seeds[2], prob_error=perr)
+    d2 = trials_of("fox","car", trials, seeds[3], prob_error=perr)
     plot_dist_distributions("box",d1,"car",d2)
 
 
@@ -0,0 +1,49 @@
+import os
+import importlib.util
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from hdc import *
+
+# hdc-branch-pred.py is not an importable module name, load it from its path
+def load_branch_pred():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hdc-branch-pred.py")
+    spec = importlib.util.spec_from_file_location("hdc_branch_pred", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# predict_inplace matches predict() and, once warmed up, allocates no arrays:
+# the traced peak over many steps stays far below one SIZE-length vector
+def test_predict_inplace_allocations(steps=1500,limit=1024):
+    bp = load_branch_pred()
+    HDC.SIZE = 10000
+    history = np.random.default_rng(2).integers(0, 2, 300 + 2 * steps)
+
+    # preallocated so the measured loop adds no entries to module dicts
+    base = peak = 0
+    for hdc in (HDC, PackedHDC):
+        for encoding_type in (bp.encodingType.RUNNING_BUNDLE, bp.encodingType.WINDOWED):
+            ref = bp.branchPredictor(history, k=4, hdc=hdc, window=50)
+            predictor = bp.branchPredictor(history, k=4, hdc=hdc, window=50, decisions=ref.decisions)
+            ref.encoding_type = predictor.encoding_type = encoding_type
+
+            expected = [ref.predict(ref.encode_history(i), ref.make_query(i)) for i in range(4, 300)]
+            assert(expected == [predictor.predict_inplace(i) for i in range(4, 300)])
+
+            tracemalloc.start()
+            for i in range(300, 300 + steps):
+                predictor.predict_inplace(i)
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            for i in range(300 + steps, 300 + 2 * steps):
+                predictor.predict_inplace(i)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            assert peak - base < limit, (hdc.__name__, encoding_type, peak - base)
+
+
+if __name__ == "__main__":
+    test_predict_inplace_allocations()
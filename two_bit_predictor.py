@@ -1,5 +1,7 @@
 import csv
 import tqdm
+import contextlib
+from branch_trace import BranchTrace, is_binary_trace, prefetch
 
 class Predictor():
     def __init__(self):
@@ -49,8 +51,13 @@ class Predictor():
         self.state_book[pc] = pc_state
 
 
-def initialize():
-    with open("traces.txt", "r") as csv_file:
+# a binary trace (see branch_trace.py) is memory mapped and indexed in place,
+# yielding the same (pc, taken) rows as the text trace
+def initialize(path="traces.txt"):
+    if is_binary_trace(path):
+        return BranchTrace(path)
+
+    with open(path, "r") as csv_file:
         csv_reader = csv.reader(csv_file)
         trace = [(row[0], bool(int(row[1]))) for row in csv_reader]
 
@@ -84,6 +91,38 @@ def test_predictor(trace,predictor):
     print(f"ACCURACY={accuracy_str}")
 
 
+# test_predictor over (pcs, outcomes) chunks, e.g. branch_trace.read_chunks(),
+# so traces of any size (text, compressed or binary) run in bounded memory.
+# the next read_ahead chunks are read on a background thread (0 disables).
+def test_predictor_stream(chunks,predictor,read_ahead=2):
+
+    correct = 0
+    seen = 0
+    accuracy_str = "0.0"
+    if read_ahead:
+        chunks = prefetch(chunks,read_ahead)
+
+    # closing the prefetching reader stops it even if a prediction raises
+    reader = contextlib.closing(chunks) if read_ahead else contextlib.nullcontext()
+    with tqdm.tqdm(unit=" branches") as pbar, reader:
+        for pcs, outcomes in chunks:
+            for cur_pc, cur_actual in zip(pcs.tolist(), outcomes.astype(bool).tolist()):
+                cur_pred = predictor.predict(cur_pc)
+
+                predictor.change_state(cur_pc,cur_actual)
+
+                if cur_actual == cur_pred:
+                    correct += 1
+
+            seen += len(outcomes)
+            accuracy_pcent = float(correct) / seen * 100
+            accuracy_str = str((float(f"{accuracy_pcent:0.4f}")))
+            pbar.set_description("accuracy=" + accuracy_str)
+            pbar.update(len(outcomes))
+
+    print(f"ACCURACY={accuracy_str}")
+
+
 def main():
     trace = initialize()
     predictor = Predictor()